@@ -6,7 +6,7 @@ Run this before deployment to validate all settings
 
 import sys
 from pathlib import Path
-from config import Settings, get_settings
+from config import settings
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -15,28 +15,29 @@ logger = logging.getLogger(__name__)
 def validate_configuration():
     """Validate all configuration settings"""
     try:
-        settings = get_settings()
-        
-        # Basic validation
-        logger.info(f"App Name: {settings.app_name}")
-        logger.info(f"Environment: {settings.environment}")
-        
-        # Test CORS origins parsing
-        logger.info(f"CORS Origins: {settings.cors_origins}")
-        
-        # Validate OpenAI settings
+        # Collect the configuration into a single report
         openai_config = settings.openai_settings
-        logger.info("OpenAI Configuration:")
-        logger.info(f"  API Base: {openai_config.api_base}")
-        logger.info(f"  API Version: {openai_config.api_version}")
-        logger.info(f"  Deployment: {openai_config.deployment_name}")
+        report = {
+            "app_name": settings.app_name,
+            "environment": settings.environment,
+            "cors_origins": settings.cors_origins,
+            "openai": {
+                "api_base": openai_config.api_base,
+                "api_version": openai_config.api_version,
+                "deployment": openai_config.deployment_name,
+            },
+        }
         
         # Check vector search configuration if enabled
         if settings.vector_search_enabled:
             vector_config = settings.vector_search_settings
-            logger.info("Vector Search Configuration:")
-            logger.info(f"  Endpoint: {vector_config.endpoint}")
-            logger.info(f"  Index: {vector_config.index_name}")
+            report["vector_search"] = {
+                "endpoint": vector_config.endpoint,
+                "index": vector_config.index_name,
+            }
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Configuration: %s", report)
             
         logger.info("Configuration validation successful!")
         return True
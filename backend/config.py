@@ -1,44 +1,82 @@
-from typing import Optional, List, Union, Dict, Any
-from pydantic import BaseModel, Field, HttpUrl, field_validator, ValidationInfo
+from typing import Optional, List, Tuple, Union, Any
+from pydantic import BaseModel, ConfigDict, Field, HttpUrl, TypeAdapter, field_validator, ValidationInfo
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from urllib.parse import urlparse as URL
-import os
-from functools import lru_cache
+from functools import cached_property, lru_cache
 import logging
 
 logger = logging.getLogger(__name__)
 
-def parse_cors_origins(v: Union[str, List[str]]) -> List[str]:
+_http_url_adapter = TypeAdapter(HttpUrl)
+
+@lru_cache(maxsize=16)
+def _expand_cors_origins(v: str) -> Tuple[str, ...]:
+    """Expand a comma-separated CORS origins string, memoized per input string"""
+    # Collect origins and their variants in one pass; dict keys dedupe in insertion order
+    expanded_origins = {}
+    for origin in v.split(","):
+        origin = origin.strip()
+        # Skip empty entries
+        if not origin:
+            continue
+        expanded_origins[origin] = None
+        # Add https variant if http is specified
+        if origin.startswith("http://"):
+            expanded_origins["https://" + origin[7:]] = None
+        # Add azurestaticapps.net variants
+        if ".azurestaticapps.net" in origin:
+            base_domain = origin.split("://", 1)[1].split(".azurestaticapps.net", 1)[0]
+            expanded_origins[f"https://{base_domain}.azurestaticapps.net"] = None
+            expanded_origins[f"http://{base_domain}.azurestaticapps.net"] = None
+    return tuple(expanded_origins)
+
+def parse_cors_origins(v: Union[str, List[str], Tuple[str, ...]]) -> Tuple[str, ...]:
     """Parse CORS origins from string or list"""
-    if isinstance(v, str):
-        # Split by comma and clean up each URL
-        origins = [origin.strip() for origin in v.split(",")]
-        # Filter out empty strings
-        origins = [origin for origin in origins if origin]
-        # Add secure variants if needed
-        expanded_origins = []
-        for origin in origins:
-            expanded_origins.append(origin)
-            # Add https variant if http is specified
-            if origin.startswith("http://"):
-                expanded_origins.append(origin.replace("http://", "https://"))
-            # Add azurestaticapps.net variants
-            if "azurestaticapps.net" in origin:
-                base_domain = origin.split("://")[1].split(".azurestaticapps.net")[0]
-                expanded_origins.append(f"https://{base_domain}.azurestaticapps.net")
-                expanded_origins.append(f"http://{base_domain}.azurestaticapps.net")
-        return list(set(expanded_origins))
-    elif isinstance(v, list):
+    # Already-decoded lists (e.g. JSON from the environment) need no expansion
+    if isinstance(v, tuple):
         return v
+    if isinstance(v, list):
+        return tuple(v)
+    if isinstance(v, str):
+        return _expand_cors_origins(v.strip())
     raise ValueError("CORS_ORIGINS must be a string or list")
 
+class OpenAISettings(BaseModel):
+    """OpenAI connection settings"""
+    model_config = ConfigDict(frozen=True)
+
+    api_key: str
+    api_base: str
+    api_version: str
+    deployment_name: str
+    temperature: float
+    max_tokens: int
+    top_p: float
+    frequency_penalty: float
+    presence_penalty: float
+
+class VectorSearchSettings(BaseModel):
+    """Vector search (Azure AI Search) settings"""
+    model_config = ConfigDict(frozen=True)
+
+    endpoint: Optional[str] = None
+    key: Optional[str] = None
+    index_name: Optional[str] = None
+    semantic_config: str = "azureml-default"
+    embedding_deployment: str = "text-embedding-ada-002"
+
+# Shared instance returned while vector search is disabled
+_DISABLED_VECTOR_SEARCH = VectorSearchSettings()
+
 class Settings(BaseSettings):
     """Main application settings"""
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
         extra="ignore",
-        case_sensitive=False
+        case_sensitive=False,
+        # Build the validation schema on first instantiation, not at class definition
+        defer_build=True
     )
 
     # Basic configuration
@@ -49,14 +87,14 @@ class Settings(BaseSettings):
     port: int = Field(default=8000)
 
     # CORS configuration
-    cors_origins: Union[str, List[str]] = Field(
-        default=["http://localhost:3000", "https://*.azurestaticapps.net"],
+    cors_origins: Union[str, Tuple[str, ...]] = Field(
+        default=("http://localhost:3000", "https://*.azurestaticapps.net"),
         description="Allowed CORS origins as comma-separated string or list"
     )
 
     # OpenAI configuration
     openai_api_key: str = Field(...)
-    openai_api_base: HttpUrl = Field(...)
+    openai_api_base: str = Field(...)
     openai_api_version: str = Field(default="2024-05-01-preview")
     openai_deployment_name: str = Field(...)
     openai_temperature: float = Field(default=0.7)
@@ -64,14 +102,34 @@ class Settings(BaseSettings):
     openai_top_p: float = Field(default=0.95)
     openai_frequency_penalty: float = Field(default=0)
     openai_presence_penalty: float = Field(default=0)
+    # Secondary Azure OpenAI resource used when the primary is rate limited or times out;
+    # key and deployment default to the primary's
+    openai_fallback_api_base: Optional[str] = None
+    openai_fallback_api_key: Optional[str] = None
+    openai_fallback_deployment_name: Optional[str] = None
     
     # Vector Search configuration
-    vector_search_enabled: bool = Field(default=False)
-    vector_search_endpoint: Optional[HttpUrl] = None
+    vector_search_endpoint: Optional[str] = None
     vector_search_key: Optional[str] = None
     vector_search_index: Optional[str] = None
     vector_search_semantic_config: str = Field(default="azureml-default")
     vector_search_embedding_deployment: str = Field(default="text-embedding-ada-002")
+    # Declared after the fields above so its validator can see them in info.data
+    vector_search_enabled: bool = Field(default=False)
+
+    # Semantic response cache
+    semantic_cache_enabled: bool = Field(default=False)
+    semantic_cache_threshold: float = Field(default=0.92)
+    semantic_cache_ttl_seconds: int = Field(default=3600)
+    semantic_cache_max_entries: int = Field(default=10000)
+    # Entry count at which an HNSW index is built and a conversation's lookups use it (needs hnswlib)
+    semantic_cache_ann_threshold: int = Field(default=1000)
+    # Embedding dimensions kept after PCA (0 keeps full embeddings), fitted once this many entries are cached
+    semantic_cache_pca_components: int = Field(default=0)
+    semantic_cache_pca_samples: int = Field(default=10000)
+    semantic_cache_embedding_deployment: str = Field(default="text-embedding-ada-002")
+    # SQLite file that keeps cached responses across restarts; memory only when unset
+    semantic_cache_path: Optional[str] = None
 
     # System configuration
     system_prompt: str = Field(
@@ -116,34 +174,89 @@ class Settings(BaseSettings):
 
         return True
 
+    @field_validator('openai_api_base', 'openai_fallback_api_base', 'vector_search_endpoint')
+    def validate_url(cls, v: Optional[str]) -> Optional[str]:
+        """Validate URLs once and keep the normalized string form"""
+        if v is None:
+            return None
+        return str(_http_url_adapter.validate_python(v))
+
     @field_validator('cors_origins')
     def validate_cors_origins(cls, v):
         return parse_cors_origins(v)
 
-    def model_post_init(self, _context):
-        """Log loaded configuration for debugging"""
-        logger.info("Loaded configuration:")
-        logger.info(f"App Name: {self.app_name}")
-        logger.info(f"Environment: {self.environment}")
-        logger.info(f"CORS Origins: {self.cors_origins}")
-        
-        if self.vector_search_enabled:
-            logger.info("Vector search is enabled")
-            logger.info(f"Vector Search Endpoint: {self.vector_search_endpoint}")
-            logger.info(f"Vector Search Index: {self.vector_search_index}")
-        else:
-            logger.info("Vector search is disabled")
-
-# Create settings instance
-@lru_cache()
-def get_settings() -> Settings:
-    """Get cached settings instance"""
+    @cached_property
+    def openai_settings(self) -> OpenAISettings:
+        """OpenAI settings grouped into a sub-model, built once per instance without re-validation"""
+        return OpenAISettings.model_construct(
+            api_key=self.openai_api_key,
+            api_base=self.openai_api_base,
+            api_version=self.openai_api_version,
+            deployment_name=self.openai_deployment_name,
+            temperature=self.openai_temperature,
+            max_tokens=self.openai_max_tokens,
+            top_p=self.openai_top_p,
+            frequency_penalty=self.openai_frequency_penalty,
+            presence_penalty=self.openai_presence_penalty
+        )
+
+    @cached_property
+    def vector_search_settings(self) -> VectorSearchSettings:
+        """Vector search settings grouped into a sub-model, built once per instance without re-validation"""
+        if not self.vector_search_enabled:
+            return _DISABLED_VECTOR_SEARCH
+        return VectorSearchSettings.model_construct(
+            endpoint=self.vector_search_endpoint,
+            key=self.vector_search_key,
+            index_name=self.vector_search_index,
+            semantic_config=self.vector_search_semantic_config,
+            embedding_deployment=self.vector_search_embedding_deployment
+        )
+
+    @cached_property
+    def is_production(self) -> bool:
+        """Whether the app runs in a production environment, computed once"""
+        return self.environment.lower() == "production"
+
+def log_settings(settings: Settings) -> None:
+    """Log loaded configuration for debugging"""
+    # Production only logs the configuration when debugging is switched on
+    if settings.is_production and not settings.debug:
+        return
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info("Loaded configuration:")
+    logger.info("App Name: %s", settings.app_name)
+    logger.info("Environment: %s", settings.environment)
+    logger.info("CORS Origins: %s", settings.cors_origins)
+
+    if settings.vector_search_enabled:
+        logger.info("Vector search is enabled")
+        logger.info("Vector Search Endpoint: %s", settings.vector_search_endpoint)
+        logger.info("Vector Search Index: %s", settings.vector_search_index)
+    else:
+        logger.info("Vector search is disabled")
+
+    if settings.openai_fallback_api_base:
+        logger.info("OpenAI fallback endpoint: %s", settings.openai_fallback_api_base)
+
+    if settings.semantic_cache_enabled:
+        logger.info("Semantic cache is enabled (threshold %s)", settings.semantic_cache_threshold)
+
+def load_settings() -> Settings:
+    """Build a Settings instance from the environment"""
     logger.info("Loading settings...")
     try:
-        return Settings()
+        loaded = Settings()
     except Exception as e:
         logger.error(f"Error loading settings: {str(e)}")
         raise
+    log_settings(loaded)
+    return loaded
 
 # Initialize settings once at module level
-settings = get_settings()
\ No newline at end of file
+settings = load_settings()
+
+def get_settings() -> Settings:
+    """Get the module-level settings instance"""
+    return settings
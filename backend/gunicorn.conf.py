@@ -1,15 +1,31 @@
 import multiprocessing
+import os
+
+from uvicorn.workers import UvicornWorker
+
+
+class ChatUvicornWorker(UvicornWorker):
+    """UvicornWorker with a cap on inbound WebSocket frame size"""
+
+    # Each frame carries the whole conversation, with answers of up to ~16 KB, so 1 MB
+    # fits long chats while still rejecting oversized frames (uvicorn's default is 16 MB)
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "ws_max_size": 1024 * 1024}
 
 # Server socket
 bind = "0.0.0.0:8000"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "uvicorn.workers.UvicornWorker"
-worker_connections = 1000
+# Async UvicornWorkers multiplex many connections each, so one per core is enough
+workers = max(2, multiprocessing.cpu_count())
+worker_class = ChatUvicornWorker
+worker_connections = 4000
 timeout = 120
-keepalive = 5
+# App Service's front end drops idle connections after about 230 s. Staying open a little
+# longer means it always closes first and never reuses a connection gunicorn just closed.
+keepalive = 240
+# Heartbeat files on tmpfs; a disk-backed /tmp can stall workers on slow I/O
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
 
 # Logging
 loglevel = "debug"
@@ -33,4 +49,8 @@ group = None
 tmp_upload_dir = None
 
 # Application
-wsgi_app = "main:app"
\ No newline at end of file
+wsgi_app = "main:app"
+# Import the app once in the master so settings, schemas and compiled patterns
+# are shared copy-on-write. The OpenAI connection pool opens no sockets until
+# the first request inside a worker, so it is safe to create before fork.
+preload_app = True
\ No newline at end of file
@@ -3,6 +3,7 @@ import contextlib
 import weakref
 from typing import Set, Optional, Dict
 import asyncio
+import heapq
 from fastapi import WebSocket, WebSocketDisconnect, status
 import aiohttp
 import time
@@ -18,111 +19,148 @@ logger.info("Starting application initialization...")
 
 from fastapi import FastAPI, HTTPException, WebSocket, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.websockets import WebSocketState
+from pydantic import BaseModel, ValidationError
+from typing import List, Optional, Dict, Any, Tuple
+from typing_extensions import TypedDict
 from datetime import datetime
-import json
 import re
-from openai import AzureOpenAI
+import httpx
+import orjson
+import numpy as np
+from openai import DEFAULT_MAX_RETRIES, APITimeoutError, AsyncAzureOpenAI, RateLimitError
 from config import settings
+from semantic_cache import CacheStore, EmbeddingBatcher, EmbeddingCache, SemanticCache, cache_namespace, context_hash
+
+# Create FastAPI app; responses are serialized with orjson
+app = FastAPI(title=settings.app_name, default_response_class=ORJSONResponse)
+
+# Split configured origins into exact matches and wildcard patterns. A bare "*" allows
+# every origin and is passed through as is; the regex form would never match a full origin.
+if "*" in settings.cors_origins:
+    exact_origins = ["*"]
+    wildcard_patterns = []
+else:
+    exact_origins = [origin for origin in settings.cors_origins if '*' not in origin]
+    wildcard_patterns = [
+        # Convert wildcard pattern to regex pattern
+        re.escape(origin).replace('\\*', '[^/]*')
+        for origin in settings.cors_origins
+        if '*' in origin
+    ]
+logger.info("Configured CORS origins: %s", settings.cors_origins)
+
+# Paths that answer with server-sent events
+SSE_PATHS = frozenset({"/chat/stream"})
+
+class StreamingGZipMiddleware(GZipMiddleware):
+    """GZip middleware that leaves server-sent event streams uncompressed"""
+
+    async def __call__(self, scope, receive, send) -> None:
+        # The compressor holds small writes back, which would stall streamed tokens
+        if scope["type"] == "http" and scope["path"] in SSE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
 
-# Create FastAPI app
-app = FastAPI(title=settings.app_name)
-
-def get_allowed_origins():
-    """Get allowed origins with proper handling of wildcard domains"""
-    origins = []
-    for origin in settings.cors_origins:
-        if '*' in origin:
-            # Convert wildcard pattern to regex pattern
-            pattern = re.escape(origin).replace('\\*', '.*')
-            origins.append(re.compile(pattern))
-        else:
-            origins.append(origin)
-    return origins
-
-def is_origin_allowed(origin: str, allowed_origins) -> bool:
-    """Check if origin is allowed, handling both exact matches and patterns"""
-    if not origin:
-        return False
-    
-    for allowed_origin in allowed_origins:
-        if isinstance(allowed_origin, re.Pattern):
-            if allowed_origin.match(origin):
-                return True
-        elif origin == allowed_origin:
-            return True
-    return False
+# Compress larger HTTP responses such as full /chat replies; WebSocket traffic is untouched.
+# Added before CORS so CORS stays the outermost middleware.
+app.add_middleware(StreamingGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+class OriginSetCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware that checks exact origins with a set lookup before the wildcard regex"""
+
+    def __init__(self, app, **kwargs) -> None:
+        super().__init__(app, **kwargs)
+        self.allow_origins = frozenset(self.allow_origins)
 
-allowed_origins = get_allowed_origins()
-logger.info(f"Configured CORS origins: {settings.cors_origins}")
+    def is_allowed_origin(self, origin: str) -> bool:
+        return origin in self.allow_origins or super().is_allowed_origin(origin)
 
 # CORS middleware configuration
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # We'll handle validation ourselves
+    OriginSetCORSMiddleware,
+    allow_origins=exact_origins,
+    allow_origin_regex='|'.join(wildcard_patterns) or None,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
     expose_headers=["*"],
 )
 
-@app.middleware("http")
-async def cors_middleware(request, call_next):
-    """Custom CORS middleware to handle wildcard subdomains"""
-    origin = request.headers.get("origin")
-    logger.debug(f"Received request from origin: {origin}")
-
-    response = await call_next(request)
-    
-    if origin:
-        if is_origin_allowed(origin, allowed_origins):
-            response.headers["Access-Control-Allow-Origin"] = origin
-            response.headers["Access-Control-Allow-Credentials"] = "true"
-            response.headers["Access-Control-Allow-Methods"] = "*"
-            response.headers["Access-Control-Allow-Headers"] = "*"
-            response.headers["Access-Control-Expose-Headers"] = "*"
-            logger.debug(f"CORS headers set for origin: {origin}")
-        else:
-            logger.warning(f"Origin not allowed: {origin}")
-    
-    return response
-
-class ChatMessage(BaseModel):
+class ChatMessage(TypedDict):
+    # Only the fields sent to OpenAI; extra keys such as the client timestamp are dropped
     role: str
     content: str
-    timestamp: str
 
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     max_tokens: Optional[int] = 4000
     temperature: Optional[float] = 0.7
+    # Set by the client to neither read nor write the semantic cache for this request
+    no_cache: bool = False
+
+# Shared HTTP connection pool reused by every OpenAI request
+http_client = httpx.AsyncClient(
+    # HTTP/2 multiplexes concurrent completion streams over one TLS connection
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
 
-# Initialize OpenAI client with configuration
-client = AzureOpenAI(
+# Initialize OpenAI client with configuration. With a fallback configured, the primary
+# retries once and the fallback not at all: a request that keeps hitting the 60 s read
+# timeout then ends within ~180 s, under App Service's 230 s request limit.
+client = AsyncAzureOpenAI(
     azure_endpoint=settings.openai_api_base,
     api_key=settings.openai_api_key,
-    api_version="2024-05-01-preview"
+    api_version="2024-05-01-preview",
+    http_client=http_client,
+    max_retries=1 if settings.openai_fallback_api_base else DEFAULT_MAX_RETRIES
 )
 
-def prepare_vector_search_config() -> Dict[str, Any]:
-    """Prepare vector search configuration based on working reference"""
+# Overflow client for 429s and timeouts that outlast the primary's retries; shares the connection pool
+fallback_client = AsyncAzureOpenAI(
+    azure_endpoint=settings.openai_fallback_api_base,
+    api_key=settings.openai_fallback_api_key or settings.openai_api_key,
+    api_version="2024-05-01-preview",
+    http_client=http_client,
+    max_retries=0
+) if settings.openai_fallback_api_base else None
+FALLBACK_DEPLOYMENT = settings.openai_fallback_deployment_name or settings.openai_deployment_name
+
+def prepare_vector_search_config() -> Optional[Dict[str, Any]]:
+    """Build the Azure AI Search request extension, or None when vector search is disabled"""
+    if not settings.vector_search_enabled:
+        return None
+
+    # Validate required settings
+    if not all([
+        settings.vector_search_endpoint,
+        settings.vector_search_key,
+        settings.vector_search_index
+    ]):
+        logger.error("Vector search is enabled but required settings are missing")
+        raise ValueError("Incomplete vector search configuration")
+
+    openai_base = settings.openai_api_base.rstrip("/")
     return {
         "data_sources": [{
             "type": "azure_search",
             "parameters": {
                 "filter": None,
-                "endpoint": str(settings.vector_search_endpoint),
+                "endpoint": settings.vector_search_endpoint,
                 "index_name": settings.vector_search_index,
-                "semantic_configuration": "azureml-default",
+                "semantic_configuration": settings.vector_search_semantic_config,
                 "authentication": {
                     "type": "api_key",
                     "key": settings.vector_search_key
                 },
                 "embedding_dependency": {
                     "type": "endpoint",
-                    "endpoint": f"{settings.openai_api_base}/openai/deployments/text-embedding-ada-002/embeddings?api-version=2023-07-01-preview",
+                    "endpoint": f"{openai_base}/openai/deployments/{settings.vector_search_embedding_deployment}/embeddings?api-version=2023-07-01-preview",
                     "authentication": {
                         "type": "api_key",
                         "key": settings.openai_api_key
@@ -137,9 +175,38 @@ def prepare_vector_search_config() -> Dict[str, Any]:
         }]
     }
 
+# Vector search configuration is immutable after startup, so build it once
+VECTOR_SEARCH_EXTRA_BODY = prepare_vector_search_config()
+
+# System prompt message prepended to every conversation
+SYSTEM_MSG = {"role": "system", "content": settings.system_prompt}
+
+# Health check fields that cannot change after startup, pre-encoded up to the timestamp value
+_HEALTH_PREFIX = orjson.dumps({
+    "status": "healthy",
+    "app_name": settings.app_name,
+    "environment": settings.environment,
+    "vector_search_enabled": settings.vector_search_enabled,
+})[:-1] + b',"timestamp":"'
+
+# Request-independent completion parameters, merged into every call
+_BASE_KWARGS: Dict[str, Any] = {
+    "model": settings.openai_deployment_name,
+    "top_p": 0.95,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+}
+if VECTOR_SEARCH_EXTRA_BODY is not None:
+    # The v1 SDK has no data_sources parameter, so it travels in the request body
+    _BASE_KWARGS["extra_body"] = VECTOR_SEARCH_EXTRA_BODY
+    logger.info("Vector search enabled with index: %s", settings.vector_search_index)
+
 class StreamMetrics:
+    # One instance per stream, touched on every chunk; slots skip the per-instance dict
+    __slots__ = ("start_ns", "chunk_count", "total_tokens", "errors")
+
     def __init__(self):
-        self.start_time = time.time()
+        self.start_ns = time.monotonic_ns()
         self.chunk_count = 0
         self.total_tokens = 0
         self.errors = 0
@@ -153,7 +220,7 @@ class StreamMetrics:
         self.errors += 1
         
     def get_metrics(self):
-        duration = time.time() - self.start_time
+        duration = (time.monotonic_ns() - self.start_ns) / 1e9
         return {
             "duration_seconds": round(duration, 2),
             "chunk_count": self.chunk_count,
@@ -171,84 +238,122 @@ async def monitor_stream(stream):
                 yield chunk
             except Exception as e:
                 metrics.record_error()
-                logger.error(f"Error processing chunk: {e}")
+                logger.error("Error processing chunk: %s", e)
     finally:
-        logger.info(f"Stream metrics: {metrics.get_metrics()}")
+        logger.info("Stream metrics: %s", metrics.get_metrics())
 
 async def generate_chat_completion(messages: List[Dict[str, str]], max_tokens: int, temperature: float, stream: bool = False):
     """Generate chat completion with robust stream handling and proper vector search"""
     try:
         completion_kwargs = {
-            "model": settings.openai_deployment_name,
+            **_BASE_KWARGS,
             "messages": messages,
             "max_tokens": max_tokens,
             "temperature": temperature,
-            "top_p": 0.95,
-            "frequency_penalty": 0,
-            "presence_penalty": 0,
             "stream": stream,
         }
         
-        if settings.vector_search_enabled:
-            # Validate required settings
-            if not all([
-                settings.vector_search_endpoint,
-                settings.vector_search_key,
-                settings.vector_search_index
-            ]):
-                logger.error("Vector search is enabled but required settings are missing")
-                raise ValueError("Incomplete vector search configuration")
-
-            # Configure vector search with explicit data source
-            completion_kwargs["dataSources"] = [{
-                "type": "azure_search",
-                "parameters": {
-                    "endpoint": str(settings.vector_search_endpoint),
-                    "key": settings.vector_search_key,
-                    "indexName": settings.vector_search_index,
-                    "semanticConfiguration": settings.vector_search_semantic_config,
-                    "queryType": "vector_simple_hybrid",
-                    "inScope": True,
-                    "roleInformation": settings.system_prompt,
-                    "strictness": 3,
-                    "topNDocuments": 5,
-                    "filter": "",  # Add any filtering conditions if needed
-                    "embeddingDeploymentName": settings.vector_search_embedding_deployment
-                }
-            }]
-            
-            logger.info(f"Vector search enabled with index: {settings.vector_search_index}")
-            logger.debug(f"Vector search configuration: {completion_kwargs['dataSources']}")
-        
-        logger.debug(f"Calling OpenAI with parameters: {completion_kwargs}")
+        # The kwargs carry the whole conversation, so only pay for the check when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Calling OpenAI with parameters: %s", completion_kwargs)
         
-        if stream:
-            async def stream_generator():
-                stream_response = client.chat.completions.create(**completion_kwargs)
-                for chunk in stream_response:
-                    yield chunk
-            return stream_generator()
-        else:
-            completion = client.chat.completions.create(**completion_kwargs)
-            return completion
+        # Streaming requests return an async iterator of chunks. The SDK already retries
+        # 429s and timeouts with exponential backoff, honouring Retry-After, before raising.
+        try:
+            return await client.chat.completions.create(**completion_kwargs)
+        except (RateLimitError, APITimeoutError) as e:
+            if fallback_client is None:
+                raise
+            logger.warning(
+                "Primary deployment failed (%s); using fallback %s",
+                type(e).__name__, settings.openai_fallback_api_base
+            )
+            completion_kwargs["model"] = FALLBACK_DEPLOYMENT
+            return await fallback_client.chat.completions.create(**completion_kwargs)
         
     except Exception as e:
-        logger.error(f"Error in chat completion: {str(e)}")
+        logger.error("Error in chat completion: %s", e)
         logger.exception(e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"OpenAI API error: {str(e)}"
         )
 
+# Paraphrased repeats of earlier prompts are answered from here instead of a new completion
+semantic_cache = SemanticCache(
+    threshold=settings.semantic_cache_threshold,
+    ttl_seconds=settings.semantic_cache_ttl_seconds,
+    max_entries=settings.semantic_cache_max_entries,
+    ann_threshold=settings.semantic_cache_ann_threshold,
+    pca_components=settings.semantic_cache_pca_components,
+    pca_samples=settings.semantic_cache_pca_samples
+) if settings.semantic_cache_enabled else None
+
+# Exact repeats of a prompt skip the embedding request entirely
+embedding_cache = EmbeddingCache() if semantic_cache is not None else None
+
+# Answers are only reused under the system prompt, deployments and search index they were
+# generated with, so changing any of these starts from an empty cache. The embedding
+# deployment matters even at equal dimensions, since each model has its own vector space.
+CACHE_NAMESPACE = cache_namespace(
+    settings.system_prompt,
+    settings.openai_deployment_name,
+    settings.semantic_cache_embedding_deployment,
+    settings.vector_search_index if settings.vector_search_enabled else ""
+)
+
+def cache_query(chat_request: ChatRequest) -> Optional[Tuple[str, int]]:
+    """Text and conversation context the semantic cache is keyed on, or None when not cacheable"""
+    if semantic_cache is None or chat_request.no_cache or not chat_request.messages:
+        return None
+    *history, message = chat_request.messages
+    if message["role"] != "user":
+        return None
+    # Earlier turns form the context, so an answer is only reused for the same conversation so far.
+    # The token limit is part of the key as well, since it bounds the answer's length.
+    return message["content"], context_hash(history, CACHE_NAMESPACE, (str(chat_request.max_tokens),))
+
+async def embed_many(texts: List[str]) -> List[List[float]]:
+    """Embed several texts in one request, in input order"""
+    result = await client.embeddings.create(
+        model=settings.semantic_cache_embedding_deployment,
+        input=texts
+    )
+    return [item.embedding for item in sorted(result.data, key=lambda item: item.index)]
+
+# Concurrent prompts share one embeddings request instead of one each
+embedding_batcher = EmbeddingBatcher(embed_many) if semantic_cache is not None else None
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    """Embed text for the semantic cache, or None if the embedding request fails"""
+    embedding = embedding_cache.get(text)
+    if embedding is not None:
+        return embedding
+    try:
+        result = await embedding_batcher.embed(text)
+    except Exception as e:
+        # The cache is an optimization; fall through to a normal completion
+        logger.warning("Semantic cache embedding failed: %s", e)
+        return None
+    return embedding_cache.put(text, result)
+
+def cache_answer(embedding: np.ndarray, answer: str, context: int) -> None:
+    """Store a completed answer in the semantic cache without failing the request"""
+    try:
+        semantic_cache.add(embedding, answer, context)
+    except Exception as e:
+        # The answer was already produced; only the cache entry is lost
+        logger.warning("Semantic cache write failed: %s", e)
+
 async def validate_openai_config():
     """Validate OpenAI configuration by making a test request"""
     try:
-        logger.info(f"Validating OpenAI configuration...")
-        logger.info(f"API Base: {settings.openai_api_base}")
-        logger.info(f"API Version: {settings.openai_api_version}")
-        logger.info(f"Deployment Name: {settings.openai_deployment_name}")
+        logger.info("Validating OpenAI configuration...")
+        logger.info("API Base: %s", settings.openai_api_base)
+        logger.info("API Version: %s", settings.openai_api_version)
+        logger.info("Deployment Name: %s", settings.openai_deployment_name)
         
-        test_completion = client.chat.completions.create(
+        test_completion = await client.chat.completions.create(
             model=settings.openai_deployment_name,
             messages=[{"role": "user", "content": "test"}],
             max_tokens=10,
@@ -258,17 +363,45 @@ async def validate_openai_config():
         logger.info("OpenAI configuration validated successfully")
         return True
     except Exception as e:
-        logger.error(f"OpenAI configuration validation failed: {str(e)}")
+        logger.error("OpenAI configuration validation failed: %s", e)
         logger.exception(e)
         return False
 
-@app.on_event("startup")
-async def startup_event():
-    """Validate configuration on startup"""
+async def report_openai_config():
+    """Run the configuration check and log a failure"""
     if not await validate_openai_config():
         logger.error("Failed to validate OpenAI configuration")
         # You might want to exit here or handle the error differently
 
+@app.on_event("startup")
+async def startup_event():
+    """Validate configuration in the background so the server accepts requests immediately"""
+    # Keep a reference so the task is not garbage collected; the test request also warms the pool
+    app.state.config_validation = asyncio.create_task(report_openai_config())
+    # Opened per worker rather than at import so preloaded workers never share a connection
+    if semantic_cache is not None and settings.semantic_cache_path:
+        semantic_cache.attach_store(CacheStore(settings.semantic_cache_path))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop pending background work and close the OpenAI connection pool and cache store"""
+    app.state.config_validation.cancel()
+    await client.close()
+    if semantic_cache is not None:
+        await embedding_batcher.close()
+        semantic_cache.close()
+
+# ISO timestamp for responses, reformatted at most once per second
+_timestamp_cache = {"second": 0, "iso": ""}
+
+def now_iso() -> str:
+    """Return the current local time as an ISO string with second resolution"""
+    second = int(time.time())
+    if second != _timestamp_cache["second"]:
+        _timestamp_cache["iso"] = datetime.fromtimestamp(second).isoformat()
+        _timestamp_cache["second"] = second
+    return _timestamp_cache["iso"]
+
 @app.get("/")
 async def root():
     """Root endpoint for debugging"""
@@ -278,6 +411,7 @@ async def root():
         "endpoints": [
             "/health",
             "/chat",
+            "/chat/stream",
             "/ws"
         ]
     }
@@ -285,27 +419,27 @@ async def root():
 @app.get("/health")
 async def health():
     """Health check endpoint that returns configuration status"""
-    return {
-        "status": "healthy",
-        "app_name": settings.app_name,
-        "environment": settings.environment,
-        "vector_search_enabled": settings.vector_search_enabled,
-        "timestamp": datetime.now().isoformat()
-    }
+    # Polled constantly by load balancers, so skip FastAPI's response encoding
+    return Response(_HEALTH_PREFIX + now_iso().encode() + b'"}', media_type="application/json")
 
 @app.post("/chat")
 async def chat(request: ChatRequest):
     """HTTP endpoint for chat functionality"""
     logger.info("Received chat request")
-    logger.debug(f"Request body: {request}")
+    logger.debug("Request body: %s", request)
     
     try:
-        messages = [
-            {"role": "system", "content": settings.system_prompt}
-        ] + [
-            {"role": m.role, "content": m.content} 
-            for m in request.messages
-        ]
+        embedding = None
+        query = cache_query(request)
+        if query is not None:
+            text, context = query
+            embedding = await embed_text(text)
+            cached = semantic_cache.lookup(embedding, context) if embedding is not None else None
+            if cached is not None:
+                logger.info("Served chat request from semantic cache")
+                return ORJSONResponse({"response": cached, "timestamp": now_iso()})
+
+        messages = [SYSTEM_MSG, *request.messages]
         
         completion = await generate_chat_completion(
             messages=messages,
@@ -314,15 +448,20 @@ async def chat(request: ChatRequest):
             stream=False
         )
 
+        choice = completion.choices[0]
         response_data = {
-            "response": completion.choices[0].message.content,
-            "timestamp": datetime.now().isoformat()
+            "response": choice.message.content,
+            "timestamp": now_iso()
         }
+        # Answers cut short by the token limit or a content filter are not reused
+        if embedding is not None and response_data["response"] and choice.finish_reason == "stop":
+            cache_answer(embedding, response_data["response"], context)
         logger.info("Successfully processed chat request")
-        return response_data
+        # Already JSON-ready, so skip FastAPI's jsonable_encoder pass
+        return ORJSONResponse(response_data)
         
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
+        logger.error("Error in chat endpoint: %s", e)
         logger.exception(e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -330,56 +469,69 @@ async def chat(request: ChatRequest):
         )
 
 class ConnectionManager:
+    # Locks are sharded by client id so unrelated clients never wait on each other
+    LOCK_SHARDS = 16
+
     def __init__(self, max_connections: int = 100, timeout: int = 600):
         self.active_connections: Dict[str, WebSocket] = {}  # Change to dict for better tracking
         self.max_connections = max_connections
         self.timeout = timeout
-        self.connection_times: Dict[str, datetime] = {}
+        # Monotonic connect times, plus a heap of (expiry, client_id) ordered by expiry
+        self.connection_times: Dict[str, float] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
         self._cleanup_task: Optional[asyncio.Task] = None
-        self._lock = asyncio.Lock()
+        self._locks = [asyncio.Lock() for _ in range(self.LOCK_SHARDS)]
+
+    def _lock_for(self, client_id: str) -> asyncio.Lock:
+        return self._locks[hash(client_id) % self.LOCK_SHARDS]
 
     async def connect(self, websocket: WebSocket) -> bool:
         client_id = f"{websocket.client.host}:{websocket.client.port}"
+        # Formatted once and kept on the connection for disconnect()
+        websocket.state.client_id = client_id
         
-        async with self._lock:
+        async with self._lock_for(client_id):
             # Check if this client already has a connection
-            if client_id in self.active_connections:
-                logger.warning(f"Client {client_id} already has an active connection")
-                try:
-                    await self.active_connections[client_id].close()
-                except Exception:
-                    pass
-                del self.active_connections[client_id]
-                del self.connection_times[client_id]
-
-            # Check total connections
+            existing = self.active_connections.pop(client_id, None)
+            if existing is not None:
+                logger.warning("Client %s already has an active connection", client_id)
+                self.connection_times.pop(client_id, None)
+                with contextlib.suppress(Exception):
+                    await existing.close()
+
+            # Check total connections and claim a slot before the next await,
+            # so concurrent connects on other shards cannot overshoot the limit
             if len(self.active_connections) >= self.max_connections:
-                logger.warning(f"Maximum connection limit reached ({self.max_connections})")
+                logger.warning("Maximum connection limit reached (%d)", self.max_connections)
                 await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
                 return False
+            connected_at = time.monotonic()
+            self.active_connections[client_id] = websocket
+            self.connection_times[client_id] = connected_at
+            heapq.heappush(self._expiry_heap, (connected_at + self.timeout, client_id))
 
             try:
                 await websocket.accept()
-                self.active_connections[client_id] = websocket
-                self.connection_times[client_id] = datetime.now()
-                logger.info(f"Client {client_id} connected. Active connections: {len(self.active_connections)}")
+                logger.info("Client %s connected. Active connections: %d", client_id, len(self.active_connections))
                 
                 if self._cleanup_task is None or self._cleanup_task.done():
                     self._cleanup_task = asyncio.create_task(self._periodic_cleanup())
                 
                 return True
             except Exception as e:
-                logger.error(f"Error accepting connection from {client_id}: {e}")
+                self.active_connections.pop(client_id, None)
+                self.connection_times.pop(client_id, None)
+                logger.error("Error accepting connection from %s: %s", client_id, e)
                 return False
 
     async def disconnect(self, websocket: WebSocket):
-        client_id = f"{websocket.client.host}:{websocket.client.port}"
-        async with self._lock:
-            if client_id in self.active_connections:
+        client_id = websocket.state.client_id
+        async with self._lock_for(client_id):
+            # Only forget the entry if it still belongs to this socket
+            if self.active_connections.get(client_id) is websocket:
                 del self.active_connections[client_id]
-                if client_id in self.connection_times:
-                    del self.connection_times[client_id]
-                logger.info(f"Client {client_id} disconnected. Active connections: {len(self.active_connections)}")
+                self.connection_times.pop(client_id, None)
+                logger.info("Client %s disconnected. Active connections: %d", client_id, len(self.active_connections))
             
             with contextlib.suppress(Exception):
                 await websocket.close()
@@ -388,35 +540,39 @@ class ConnectionManager:
         while True:
             try:
                 await asyncio.sleep(30)  # Check every 30 seconds
-                async with self._lock:
-                    now = datetime.now()
-                    stale_connections = []
-                    
-                    for client_id, ws in self.active_connections.items():
-                        if not ws.client_state.connected:
-                            stale_connections.append(client_id)
-                        elif (now - self.connection_times[client_id]).total_seconds() > self.timeout:
-                            stale_connections.append(client_id)
-                    
-                    for client_id in stale_connections:
-                        if client_id in self.active_connections:
-                            await self.disconnect(self.active_connections[client_id])
+                # Pop only expired heap entries instead of scanning every connection;
+                # closed sockets are already removed by the endpoint's own disconnect()
+                now = time.monotonic()
+                stale_connections = []
+                while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                    expiry, client_id = heapq.heappop(self._expiry_heap)
+                    connected_at = self.connection_times.get(client_id)
+                    # Skip entries left behind by a connection that has since been replaced
+                    if connected_at is not None and connected_at + self.timeout == expiry:
+                        stale_connections.append(self.active_connections[client_id])
+                
+                for ws in stale_connections:
+                    await self.disconnect(ws)
                             
             except Exception as e:
-                logger.error(f"Error in periodic cleanup: {e}")
+                logger.error("Error in periodic cleanup: %s", e)
 
     def get_connection_count(self) -> int:
         return len(self.active_connections)
 
     def get_connection_info(self) -> dict:
+        now = time.monotonic()
+        wall_now = time.time()
         return {
             "total_connections": len(self.active_connections),
             "max_connections": self.max_connections,
             "clients": [
                 {
                     "id": client_id,
-                    "connected_at": self.connection_times[client_id].isoformat(),
-                    "duration": (datetime.now() - self.connection_times[client_id]).total_seconds()
+                    "connected_at": datetime.fromtimestamp(
+                        wall_now - (now - self.connection_times[client_id])
+                    ).isoformat(),
+                    "duration": now - self.connection_times[client_id]
                 }
                 for client_id in self.active_connections
             ]
@@ -425,88 +581,265 @@ class ConnectionManager:
 # Initialize the connection manager
 manager = ConnectionManager()
 
-async def stream_generator(stream):
+async def close_stream(stream) -> None:
+    """Release the Azure response so an abandoned stream stops generating billed tokens"""
+    # No-op once the body has been read to completion
+    await stream.response.aclose()
+
+class StreamOutcome:
+    """How a streamed completion ended, filled in by stream_generator"""
+    __slots__ = ("finish_reason",)
+
+    def __init__(self):
+        self.finish_reason: Optional[str] = None
+
+async def stream_generator(stream, outcome: Optional[StreamOutcome] = None):
     try:
         async for chunk in stream:
-            if chunk and chunk.choices and chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
+            if chunk and chunk.choices:
+                choice = chunk.choices[0]
+                if outcome is not None and choice.finish_reason:
+                    outcome.finish_reason = choice.finish_reason
+                # Resolve the delta content once per chunk
+                content = choice.delta.content
+                if content:
+                    yield content
     except Exception as e:
-        logger.error(f"Error in stream_generator: {str(e)}")
+        logger.error("Error in stream_generator: %s", e)
         raise
+    finally:
+        # Also runs when a disconnected SSE client cancels the response mid-stream
+        await close_stream(stream)
+
+# Streamed content arriving in bursts is coalesced into fewer WebSocket frames
+WS_FLUSH_MAX_CHUNKS = 16
+WS_FLUSH_INTERVAL = 0.004  # seconds
+# A client that cannot take a frame within this time is treated as stalled
+WS_SEND_TIMEOUT = 5.0  # seconds
+
+# Cached answers are replayed in small frames so the client still renders them progressively
+WS_REPLAY_CHUNK_SIZE = 20  # characters
+
+async def send_buffered(websocket: WebSocket, contents, transcript: Optional[List[str]] = None) -> bool:
+    """Forward streamed content to the websocket, batching chunks that arrive together.
+
+    Buffered text is sent at most WS_FLUSH_INTERVAL after its first chunk arrived, even
+    if the stream pauses. Sent text is also appended to transcript when given. Returns
+    False if the client went away before the stream ended.
+    """
+    loop = asyncio.get_running_loop()
+    buffer: List[str] = []
+    flush_at = 0.0
+    iterator = contents.__aiter__()
+    # The next chunk is read in a task so a flush deadline can pass without cancelling the read
+    pending: Optional[asyncio.Future] = None
+
+    async def flush() -> None:
+        text = "".join(buffer)
+        buffer.clear()
+        await asyncio.wait_for(websocket.send_text(text), WS_SEND_TIMEOUT)
+        if transcript is not None:
+            transcript.append(text)
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait((pending,), timeout=flush_at - loop.time())
+                if not done:
+                    await flush()
+                    continue
+            try:
+                content = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+            # The reader task marks the socket disconnected as soon as the client goes away
+            if websocket.client_state != WebSocketState.CONNECTED:
+                logger.info("Client disconnected mid-stream; abandoning completion")
+                return False
+            if not buffer:
+                flush_at = loop.time() + WS_FLUSH_INTERVAL
+            buffer.append(content)
+            if len(buffer) >= WS_FLUSH_MAX_CHUNKS:
+                await flush()
+    finally:
+        if pending is not None:
+            pending.cancel()
+    if buffer:
+        await flush()
+    return True
+
+async def replay_cached(websocket: WebSocket, text: str) -> None:
+    """Send a cached answer in small frames, yielding to other connections between them"""
+    for offset in range(0, len(text), WS_REPLAY_CHUNK_SIZE):
+        if websocket.client_state != WebSocketState.CONNECTED:
+            return
+        await asyncio.wait_for(
+            websocket.send_text(text[offset:offset + WS_REPLAY_CHUNK_SIZE]), WS_SEND_TIMEOUT
+        )
+        await asyncio.sleep(0)
+
+async def sse_events(contents):
+    """Encode streamed content as server-sent events, ending with a done event"""
+    try:
+        async for content in contents:
+            yield b"data: " + orjson.dumps({"token": content}) + b"\n\n"
+    except Exception as e:
+        # Headers are already sent, so report the failure in-band
+        logger.error("Error in chat stream: %s", e)
+        yield b"data: " + orjson.dumps({"error": str(e)}) + b"\n\n"
+        return
+    yield b'data: {"done":true}\n\n'
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """HTTP endpoint streaming the chat response as server-sent events"""
+    logger.info("Received streaming chat request")
+
+    # Create the completion up front so API errors still surface as a 500
+    stream = await generate_chat_completion(
+        messages=[SYSTEM_MSG, *request.messages],
+        max_tokens=request.max_tokens,
+        temperature=request.temperature,
+        stream=True
+    )
+    return StreamingResponse(
+        sse_events(stream_generator(stream)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Frames received while a response is still streaming wait here; bounded so a client cannot pile up work
+WS_RECEIVE_QUEUE_SIZE = 4
+
+async def receive_messages(websocket: WebSocket, queue: "asyncio.Queue[Optional[str]]") -> None:
+    """Read incoming frames into the queue, ending with None once the client goes away"""
+    try:
+        while True:
+            await queue.put(await websocket.receive_text())
+    except WebSocketDisconnect:
+        logger.info("WebSocket disconnected")
+    except Exception as e:
+        logger.error("Error receiving WebSocket message: %s", e)
+    finally:
+        await queue.put(None)
+
+async def send_error(websocket: WebSocket, message: str) -> None:
+    """Report an error to the client, closing the connection if it cannot take the frame"""
+    if websocket.client_state != WebSocketState.CONNECTED:
+        return
+    try:
+        await asyncio.wait_for(websocket.send_text(message), WS_SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("WebSocket send timed out; closing connection")
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+
+async def handle_message(websocket: WebSocket, data: str) -> None:
+    """Validate one chat request frame and stream the completion back"""
+    logger.info("Received WebSocket message")
+    logger.debug("Message content: %.100s...", data)
+    
+    # Parse and validate in one pass; malformed JSON surfaces as a ValidationError too
+    try:
+        chat_request = ChatRequest.model_validate_json(data)
+    except ValidationError as e:
+        error_msg = f"Invalid request format: {str(e)}"
+        logger.error(error_msg)
+        await send_error(websocket, error_msg)
+        return
+    
+    messages = [SYSTEM_MSG, *chat_request.messages]
+    
+    stream = None
+    try:
+        embedding = None
+        query = cache_query(chat_request)
+        if query is not None:
+            text, context = query
+            embedding = await embed_text(text)
+            cached = semantic_cache.lookup(embedding, context) if embedding is not None else None
+            if cached is not None:
+                logger.info("Served WebSocket message from semantic cache")
+                await replay_cached(websocket, cached)
+                return
+
+        stream = await generate_chat_completion(
+            messages=messages,
+            max_tokens=chat_request.max_tokens,
+            temperature=chat_request.temperature,
+            stream=True
+        )
+        
+        # Keep what was streamed so a completed answer can be cached for later repeats
+        transcript: Optional[List[str]] = [] if embedding is not None else None
+        outcome = StreamOutcome()
+        completed = await send_buffered(websocket, stream_generator(stream, outcome), transcript)
+        # Answers cut short by the token limit or a content filter are not reused
+        if completed and transcript and outcome.finish_reason == "stop":
+            cache_answer(embedding, "".join(transcript), context)
+        
+    except asyncio.TimeoutError:
+        # Stop streaming to a stalled client instead of buffering tokens for it
+        logger.warning("WebSocket send timed out; closing connection")
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    except Exception as e:
+        error_msg = f"OpenAI API error: {str(e)}"
+        logger.error(error_msg)
+        logger.exception(e)
+        await send_error(websocket, f"Error: {str(e)}")
+    finally:
+        if stream is not None:
+            await close_stream(stream)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time chat functionality with proper stream handling"""
+    reader = None
     try:
         if not await manager.connect(websocket):
             return
 
-        while True:
-            try:
-                data = await websocket.receive_text()
-                logger.info("Received WebSocket message")
-                logger.debug(f"Message content: {data[:100]}...")
-                
-                try:
-                    request_data = json.loads(data)
-                    logger.debug(f"Parsed request data: {request_data}")
-                except json.JSONDecodeError as e:
-                    error_msg = f"Invalid JSON format: {str(e)}"
-                    logger.error(error_msg)
-                    await websocket.send_text(error_msg)
-                    continue
+        # Receiving runs independently so frames are read while a response streams;
+        # responses are still sent one at a time so their text never interleaves
+        queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue(maxsize=WS_RECEIVE_QUEUE_SIZE)
+        reader = asyncio.create_task(receive_messages(websocket, queue))
 
-                try:
-                    chat_request = ChatRequest(**request_data)
-                except Exception as e:
-                    error_msg = f"Invalid request format: {str(e)}"
-                    logger.error(error_msg)
-                    await websocket.send_text(error_msg)
-                    continue
-                
-                messages = [
-                    {"role": "system", "content": settings.system_prompt}
-                ] + [
-                    {"role": m.role, "content": m.content} 
-                    for m in chat_request.messages
-                ]
-                
-                try:
-                    stream = await generate_chat_completion(
-                        messages=messages,
-                        max_tokens=chat_request.max_tokens,
-                        temperature=chat_request.temperature,
-                        stream=True
-                    )
-                    
-                    async for content in stream_generator(stream):
-                        await websocket.send_text(content)
-                    
-                except Exception as e:
-                    error_msg = f"OpenAI API error: {str(e)}"
-                    logger.error(error_msg)
-                    logger.exception(e)
-                    await websocket.send_text(f"Error: {str(e)}")
-                    
-            except WebSocketDisconnect:
-                logger.info("WebSocket disconnected")
+        while True:
+            data = await queue.get()
+            if data is None:
                 break
+            try:
+                await handle_message(websocket, data)
             except Exception as e:
-                logger.error(f"Error processing message: {str(e)}")
+                logger.error("Error processing message: %s", e)
                 logger.exception(e)
-                await websocket.send_text(f"Error: {str(e)}")
+                await send_error(websocket, f"Error: {str(e)}")
+            # handle_message closes the socket on a stalled client; drop anything still queued
+            if websocket.application_state == WebSocketState.DISCONNECTED:
+                break
                 
     except Exception as e:
-        logger.error(f"WebSocket connection error: {str(e)}")
+        logger.error("WebSocket connection error: %s", e)
         logger.exception(e)
     finally:
+        if reader is not None:
+            reader.cancel()
         await manager.disconnect(websocket)
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
     uvicorn.run(
         "main:app",
         host=settings.host,
         port=settings.port,
-        reload=settings.debug
+        reload=settings.debug,
+        # Same inbound frame cap as the gunicorn worker
+        ws_max_size=1024 * 1024,
+        # uvloop is only pinned for non-Windows platforms in requirements.txt
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools"
     )
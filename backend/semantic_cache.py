@@ -0,0 +1,539 @@
+import asyncio
+import bisect
+import functools
+import hashlib
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional; large caches fall back to the flat NumPy scan
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+def _update_parts(digest, parts: Sequence[str]) -> None:
+    for part in parts:
+        data = part.encode("utf-8")
+        # Length-prefix each part so different splits never hash alike
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+
+def cache_namespace(*parts: str) -> bytes:
+    """Key for the settings cached answers depend on, such as the system prompt and deployment"""
+    digest = hashlib.blake2b(digest_size=32)
+    _update_parts(digest, parts)
+    return digest.digest()
+
+def context_hash(messages: Sequence[Mapping[str, str]], namespace: bytes = b"",
+                 options: Sequence[str] = ()) -> int:
+    """64-bit key for a conversation prefix and the request options an answer depends on"""
+    # Keying the hash with the namespace keeps contexts from different namespaces apart
+    digest = hashlib.blake2b(digest_size=8, key=namespace)
+    _update_parts(digest, options)
+    for message in messages:
+        _update_parts(digest, (message["role"], message["content"]))
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+class CacheStore:
+    """SQLite persistence for semantic cache entries so they survive restarts"""
+
+    # Seconds between deletes of expired rows; loads skip them regardless
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self, path: str):
+        # Loading happens on the event loop at startup, writes on the writer thread
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets several workers share the file without blocking each other's reads
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "context INTEGER NOT NULL, "
+            "embedding BLOB NOT NULL, "
+            "response TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_entries_created_at ON cache_entries (created_at)"
+        )
+        self._conn.commit()
+        # One thread runs every write in order, so waiting on another worker's lock
+        # never stalls the event loop
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-store")
+        self._last_prune = 0.0
+
+    def load(self, max_age: float, limit: int) -> List[Tuple[int, bytes, str, float]]:
+        """Drop stale rows and return the newest live ones, oldest first"""
+        self.prune(max_age)
+        # Only rows the size of the newest one; older rows came from a different embedding model
+        rows = self._conn.execute(
+            "SELECT context, embedding, response, created_at FROM cache_entries "
+            "WHERE length(embedding) = "
+            "(SELECT length(embedding) FROM cache_entries ORDER BY id DESC LIMIT 1) "
+            "ORDER BY id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        rows.reverse()
+        return rows
+
+    def add(self, context: int, vector: np.ndarray, response: str, created_at: float,
+            max_age: float) -> None:
+        """Queue a row for the writer thread, which also prunes rows older than max_age"""
+        row = (context, vector.astype(np.float32).tobytes(), response, created_at)
+        self._writer.submit(self._write, row, max_age)
+
+    def prune(self, max_age: float) -> None:
+        """Delete rows older than max_age seconds"""
+        self._conn.execute("DELETE FROM cache_entries WHERE created_at < ?", (time.time() - max_age,))
+        self._conn.commit()
+
+    def close(self) -> None:
+        """Finish queued writes and close the database"""
+        self._writer.shutdown(wait=True)
+        self._conn.close()
+
+    def _write(self, row: Tuple[int, bytes, str, float], max_age: float) -> None:
+        """Insert a row, deleting expired ones at most every PRUNE_INTERVAL seconds"""
+        try:
+            self._conn.execute(
+                "INSERT INTO cache_entries (context, embedding, response, created_at) VALUES (?, ?, ?, ?)",
+                row
+            )
+            now = time.time()
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                self._last_prune = now
+                self._conn.execute("DELETE FROM cache_entries WHERE created_at < ?", (now - max_age,))
+            self._conn.commit()
+        except sqlite3.Error as e:
+            # Runs in the executor, where an exception would go unnoticed
+            logger.warning("Semantic cache store write failed: %s", e)
+
+class SemanticCache:
+    """In-memory response cache matching prompts by embedding cosine similarity"""
+
+    # HNSW graph parameters used once the cache outgrows the flat scan
+    HNSW_M = 32
+    HNSW_EF_CONSTRUCTION = 200
+    HNSW_EF_SEARCH = 64
+
+    def __init__(self, threshold: float = 0.92, ttl_seconds: float = 3600, max_entries: int = 10000,
+                 ann_threshold: int = 1000, pca_components: int = 0, pca_samples: int = 10000):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.ann_threshold = ann_threshold
+        # Dimensions kept after PCA (0 disables it) and the entry count the projection is fitted on
+        self.pca_components = pca_components
+        self.pca_samples = min(pca_samples, max_entries)
+        # Rows are L2-normalized so a dot product is the cosine similarity. Live rows are
+        # _vectors[_start:_start + len(self)], oldest first; dropping old entries only
+        # advances _start and the dead prefix is reclaimed when the buffer fills up.
+        self._vectors: Optional[np.ndarray] = None
+        # Conversation context key of each row, parallel to _vectors
+        self._contexts: Optional[np.ndarray] = None
+        self._start = 0
+        self._responses: List[str] = []
+        self._created: List[float] = []
+        # Entries get increasing ids that double as HNSW labels; this is the oldest live one
+        self._first_id = 0
+        # Size of the embeddings as given, before any PCA reduction
+        self._dimension: Optional[int] = None
+        self._index = None
+        # Background task fitting PCA or building the index, while one runs
+        self._maintenance: Optional[asyncio.Task] = None
+        self._store: Optional[CacheStore] = None
+        # Full-dimension to reduced-dimension projection, once fitted
+        self._projection: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+    @staticmethod
+    def normalize(embedding: Sequence[float]) -> np.ndarray:
+        """Convert an embedding to a unit-length float32 vector"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding: Sequence[float], context: int = 0) -> Optional[str]:
+        """Return the cached response closest to the embedding within a context, if similar enough"""
+        self._evict_expired()
+        size = len(self._responses)
+        if not size:
+            return None
+
+        vector = self.normalize(embedding)
+        if vector.shape[0] != self._dimension:
+            # Entries come from a different embedding model
+            return None
+        query = self._reduce(vector)
+        start = self._start
+        in_context = self._contexts[start:start + size] == context
+        count = int(np.count_nonzero(in_context))
+        if not count:
+            return None
+        # The graph filter visits nodes of every context, so it only beats the flat
+        # scan when this context alone is large enough to warrant an index
+        if self._index is not None and count >= self.ann_threshold:
+            # Approximate nearest neighbour restricted to the context; cosine distance is 1 - similarity
+            contexts = self._contexts
+            first_id = self._first_id
+            try:
+                labels, distances = self._index.knn_query(
+                    query, k=1, num_threads=1,
+                    filter=lambda label: contexts[start + label - first_id] == context
+                )
+            except RuntimeError:
+                return None
+            best = int(labels[0][0]) - first_id
+            similarity = 1.0 - float(distances[0][0])
+        else:
+            # Score the contiguous live rows in one product, then keep the context's best;
+            # this is cheaper than gathering the context's rows into a copy first
+            similarities = self._vectors[start:start + size] @ query
+            best = int(np.argmax(np.where(in_context, similarities, -np.inf)))
+            similarity = float(similarities[best])
+
+        if similarity < self.threshold:
+            return None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Semantic cache hit (similarity %.3f)", similarity)
+        return self._responses[best]
+
+    def add(self, embedding: Sequence[float], response: str, context: int = 0) -> None:
+        """Cache a response under its prompt embedding and conversation context"""
+        vector = self.normalize(embedding)
+        self._append(vector, response, context, time.monotonic())
+        if self._store is not None:
+            self._store.add(context, vector, response, time.time(), self.ttl_seconds)
+
+    def attach_store(self, store: CacheStore) -> None:
+        """Restore persisted entries that are still within the TTL and persist new ones"""
+        # Persisted times are wall clock; map them onto the monotonic clock used in memory
+        offset = time.monotonic() - time.time()
+        for context, blob, response, created_at in store.load(self.ttl_seconds, self.max_entries):
+            self._append(np.frombuffer(blob, dtype=np.float32), response, context, created_at + offset)
+        if self._responses:
+            logger.info("Loaded %d semantic cache entries", len(self._responses))
+        self._store = store
+
+    def close(self) -> None:
+        """Stop background work and close the attached store, if any"""
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            self._maintenance = None
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _reduce(self, vector: np.ndarray) -> np.ndarray:
+        """Project a normalized full-dimension vector into the PCA space, if fitted"""
+        if self._projection is None:
+            return vector
+        return self.normalize(vector @ self._projection)
+
+    def _append(self, vector: np.ndarray, response: str, context: int, created: float) -> None:
+        """Store a normalized full-dimension vector as the newest entry, evicting as needed"""
+        if self._dimension != vector.shape[0]:
+            if self._dimension is not None:
+                logger.warning("Embedding size changed from %d to %d; clearing the semantic cache",
+                               self._dimension, vector.shape[0])
+                self._clear()
+            self._dimension = vector.shape[0]
+        vector = self._reduce(vector)
+        self._evict_expired()
+        if len(self._responses) >= self.max_entries:
+            self._drop_oldest(len(self._responses) - self.max_entries + 1)
+
+        size = len(self._responses)
+        if self._vectors is None:
+            self._vectors = np.empty((min(64, self.max_entries), vector.shape[0]), dtype=np.float32)
+            self._contexts = np.empty(self._vectors.shape[0], dtype=np.int64)
+        elif self._start + size == self._vectors.shape[0]:
+            self._make_room(size)
+
+        entry_id = self._first_id + size
+        self._vectors[self._start + size] = vector
+        self._contexts[self._start + size] = context
+        self._responses.append(response)
+        self._created.append(created)
+
+        if self._index is not None:
+            self._index.add_items(vector[np.newaxis], [entry_id], replace_deleted=True)
+
+        self._schedule_maintenance()
+
+    @staticmethod
+    def _fit_projection(rows: np.ndarray, components: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Fit PCA on rows and return the projection and the reduced, normalized rows"""
+        # Uncentered PCA (truncated SVD) keeps dot products, and so the similarity
+        # threshold, approximately unchanged for vectors near the fitted subspace
+        _, _, basis = np.linalg.svd(rows, full_matrices=False)
+        projection = np.ascontiguousarray(basis[:components].T)
+        reduced = rows @ projection
+        reduced /= np.maximum(np.linalg.norm(reduced, axis=1, keepdims=True), 1e-12)
+        return projection, reduced
+
+    def _install_projection(self, fitted: Tuple[np.ndarray, np.ndarray], first_id: int) -> None:
+        """Move the live entries into the reduced space fitted on entries from first_id on"""
+        projection, reduced = fitted
+        size = len(self._responses)
+        # Rows evicted while fitting are skipped; rows added meanwhile are projected now
+        reduced = reduced[self._first_id - first_id:]
+        covered = len(reduced)
+        vectors = np.empty((self._vectors.shape[0], projection.shape[1]), dtype=np.float32)
+        vectors[:covered] = reduced
+        if covered < size:
+            added = self._vectors[self._start + covered:self._start + size] @ projection
+            added /= np.maximum(np.linalg.norm(added, axis=1, keepdims=True), 1e-12)
+            vectors[covered:size] = added
+        self._contexts[:size] = self._contexts[self._start:self._start + size]
+        self._vectors = vectors
+        self._start = 0
+        self._projection = projection
+        # The graph was built in the old space; a new one is built in the background
+        self._index = None
+        logger.info("Semantic cache reduced embeddings to %d dimensions with PCA", projection.shape[1])
+
+    def _make_room(self, size: int) -> None:
+        """Reclaim the dead prefix or grow the buffer so one more row fits"""
+        if self._start and self._start >= size:
+            # At least half the buffer is dead: compact live rows to the front
+            self._vectors[:size] = self._vectors[self._start:self._start + size]
+            self._contexts[:size] = self._contexts[self._start:self._start + size]
+            self._start = 0
+            return
+        # Grow geometrically, up to twice max_entries so compaction stays amortized O(d)
+        capacity = min(self._vectors.shape[0] * 2, 2 * self.max_entries)
+        grown = np.empty((capacity, self._vectors.shape[1]), dtype=np.float32)
+        grown[:size] = self._vectors[self._start:self._start + size]
+        contexts = np.empty(capacity, dtype=np.int64)
+        contexts[:size] = self._contexts[self._start:self._start + size]
+        self._vectors = grown
+        self._contexts = contexts
+        self._start = 0
+
+    def _next_job(self) -> Optional[Tuple[Callable[[], Any], Callable[[Any], None]]]:
+        """Heavy work now due: a function safe to run in a thread, and one installing its result"""
+        size = len(self._responses)
+        # The SVD yields at most one component per row, so PCA also waits for enough rows
+        if (self._projection is None and 0 < self.pca_components < self._vectors.shape[1]
+                and size >= max(self.pca_samples, self.pca_components)):
+            rows = self._vectors[self._start:self._start + size].copy()
+            return (
+                functools.partial(self._fit_projection, rows, self.pca_components),
+                functools.partial(self._install_projection, first_id=self._first_id)
+            )
+        if self._index is None and hnswlib is not None and size >= self.ann_threshold:
+            # The thread works on a copy; entries added or evicted meanwhile are caught up on install
+            rows = self._vectors[self._start:self._start + size].copy()
+            first_id = self._first_id
+            return (
+                functools.partial(self._new_index, rows, first_id),
+                functools.partial(self._install_index, first_id=first_id, end_id=first_id + size)
+            )
+        return None
+
+    def _schedule_maintenance(self) -> None:
+        """Start due work in a thread when an event loop is running, otherwise run it inline"""
+        if self._maintenance is not None:
+            return
+        job = self._next_job()
+        if job is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            while job is not None:
+                compute, install = job
+                install(compute())
+                job = self._next_job()
+            return
+        self._maintenance = loop.create_task(self._maintain(*job))
+
+    async def _maintain(self, compute: Callable[[], Any], install: Callable[[Any], None]) -> None:
+        """Run a job off the event loop so lookups and streams keep going meanwhile"""
+        try:
+            install(await asyncio.to_thread(compute))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Retried on a later add
+            logger.error("Semantic cache maintenance failed: %s", e)
+            self._maintenance = None
+            return
+        self._maintenance = None
+        # Work that became due meanwhile
+        self._schedule_maintenance()
+
+    def _new_index(self, rows: np.ndarray, first_id: int):
+        """Build an HNSW graph over rows labelled from first_id; touches no cache state"""
+        index = hnswlib.Index(space="cosine", dim=rows.shape[1])
+        index.init_index(
+            max_elements=self.max_entries,
+            M=self.HNSW_M,
+            ef_construction=self.HNSW_EF_CONSTRUCTION,
+            allow_replace_deleted=True
+        )
+        index.add_items(rows, np.arange(first_id, first_id + len(rows)))
+        index.set_ef(self.HNSW_EF_SEARCH)
+        return index
+
+    def _install_index(self, index, first_id: int, end_id: int) -> None:
+        """Switch lookups to an index built from entries first_id to end_id"""
+        # Entries evicted while the graph was built
+        for entry_id in range(first_id, min(self._first_id, end_id)):
+            index.mark_deleted(entry_id)
+        # Entries added while the graph was built
+        size = len(self._responses)
+        start_id = max(end_id, self._first_id)
+        end_live = self._first_id + size
+        if start_id < end_live:
+            index.add_items(
+                self._vectors[self._start + start_id - self._first_id:self._start + size],
+                np.arange(start_id, end_live),
+                replace_deleted=True
+            )
+        self._index = index
+        logger.info("Semantic cache switched to HNSW index at %d entries", size)
+
+    def _clear(self) -> None:
+        """Drop every entry along with the fitted projection and index"""
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            self._maintenance = None
+        self._first_id += len(self._responses)
+        self._vectors = None
+        self._contexts = None
+        self._start = 0
+        self._responses = []
+        self._created = []
+        self._index = None
+        self._projection = None
+
+    def _evict_expired(self) -> None:
+        """Drop entries older than the TTL"""
+        if not self._created:
+            return
+        expired = bisect.bisect_left(self._created, time.monotonic() - self.ttl_seconds)
+        if expired:
+            self._drop_oldest(expired)
+
+    def _drop_oldest(self, count: int) -> None:
+        """Remove the count oldest entries"""
+        if self._index is not None:
+            for entry_id in range(self._first_id, self._first_id + count):
+                self._index.mark_deleted(entry_id)
+        self._start += count
+        self._first_id += count
+        del self._responses[:count]
+        del self._created[:count]
+        if not self._responses:
+            self._start = 0
+
+class EmbeddingCache:
+    """LRU cache of embeddings keyed by a hash of the embedded text"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Fixed-size key so long prompts are not kept alive as dict keys"""
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """Return the cached embedding for text, marking it recently used"""
+        key = self.key(text)
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+        return embedding
+
+    def put(self, text: str, embedding: Sequence[float]) -> np.ndarray:
+        """Store an embedding as float32 and return the stored array"""
+        key = self.key(text)
+        stored = np.asarray(embedding, dtype=np.float32)
+        self._entries[key] = stored
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return stored
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding requests into one API call per batch"""
+
+    def __init__(self, embed_many: Callable[[List[str]], Awaitable[List[Sequence[float]]]],
+                 max_batch: int = 16, max_wait: float = 0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._embed_many = embed_many
+        # Created on first use so they bind to the running event loop
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector: Optional[asyncio.Task] = None
+        # In-flight batch requests, referenced so they are not garbage collected
+        self._requests: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> Sequence[float]:
+        """Embed text as part of the next batch"""
+        if self._collector is None:
+            self._queue = asyncio.Queue()
+            self._collector = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _collect(self) -> None:
+        """Gather up to max_batch texts, waiting at most max_wait after the first"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Send without awaiting so the next batch can gather during this request
+            request = asyncio.create_task(self._send(batch))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        """Embed a batch and resolve each caller's future with its row"""
+        try:
+            embeddings = await self._embed_many([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            # Callers that gave up have cancelled their future
+            if not future.done():
+                future.set_result(embedding)
+
+    async def close(self) -> None:
+        """Stop collecting and cancel in-flight batch requests"""
+        tasks = list(self._requests)
+        if self._collector is not None:
+            tasks.append(self._collector)
+            self._collector = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
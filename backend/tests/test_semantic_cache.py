@@ -0,0 +1,299 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import semantic_cache
+from semantic_cache import (
+    CacheStore,
+    EmbeddingBatcher,
+    EmbeddingCache,
+    SemanticCache,
+    cache_namespace,
+    context_hash,
+)
+
+DIM = 64
+
+def random_vectors(count: int, dim: int = DIM, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+def low_rank_vectors(count: int, rank: int = 12, dim: int = DIM, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    basis = rng.normal(size=(rank, dim))
+    return (rng.normal(size=(count, rank)) @ basis + rng.normal(size=(count, dim)) * 0.05).astype(np.float32)
+
+class FakeClock:
+    """Stands in for time.monotonic and time.time inside semantic_cache"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class ContextHashTest(unittest.TestCase):
+    def test_same_input_same_key(self):
+        messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        self.assertEqual(context_hash(messages), context_hash(list(messages)))
+
+    def test_part_boundaries_matter(self):
+        self.assertNotEqual(
+            context_hash([{"role": "user", "content": "ab"}]),
+            context_hash([{"role": "usera", "content": "b"}])
+        )
+
+    def test_namespace_and_options_separate_keys(self):
+        messages = [{"role": "user", "content": "hi"}]
+        base = context_hash(messages)
+        self.assertNotEqual(base, context_hash(messages, cache_namespace("prompt", "gpt")))
+        self.assertNotEqual(
+            context_hash(messages, cache_namespace("prompt", "gpt")),
+            context_hash(messages, cache_namespace("other prompt", "gpt"))
+        )
+        self.assertNotEqual(context_hash(messages, options=("20",)), context_hash(messages, options=("4000",)))
+
+class SemanticCacheTest(unittest.TestCase):
+    def test_lookup_returns_closest_within_threshold(self):
+        vectors = random_vectors(5)
+        cache = SemanticCache(threshold=0.9, ann_threshold=10**9)
+        for i, vector in enumerate(vectors):
+            cache.add(vector, str(i))
+        self.assertEqual(cache.lookup(vectors[3] * 2.5), "3")
+        self.assertEqual(cache.lookup(vectors[3] + 0.01 * vectors[1]), "3")
+        self.assertIsNone(cache.lookup(random_vectors(1, seed=1)[0]))
+
+    def test_lookup_on_empty_cache(self):
+        self.assertIsNone(SemanticCache().lookup(random_vectors(1)[0]))
+
+    def test_context_filter(self):
+        vector = random_vectors(1)[0]
+        cache = SemanticCache(threshold=0.9, ann_threshold=10**9)
+        cache.add(vector, "first", context=1)
+        cache.add(vector, "second", context=2)
+        self.assertEqual(cache.lookup(vector, context=1), "first")
+        self.assertEqual(cache.lookup(vector, context=2), "second")
+        self.assertIsNone(cache.lookup(vector, context=3))
+
+    def test_ttl_eviction(self):
+        clock = FakeClock()
+        vectors = random_vectors(3)
+        cache = SemanticCache(threshold=0.9, ttl_seconds=60, ann_threshold=10**9)
+        with mock.patch.object(semantic_cache.time, "monotonic", clock):
+            cache.add(vectors[0], "old")
+            clock.now += 40
+            cache.add(vectors[1], "newer")
+            clock.now += 30
+            self.assertIsNone(cache.lookup(vectors[0]))
+            self.assertEqual(cache.lookup(vectors[1]), "newer")
+            self.assertEqual(len(cache), 1)
+            clock.now += 100
+            self.assertIsNone(cache.lookup(vectors[1]))
+            self.assertEqual(len(cache), 0)
+            # An emptied cache keeps working
+            cache.add(vectors[2], "again")
+            self.assertEqual(cache.lookup(vectors[2]), "again")
+
+    def test_max_entries_drops_oldest_through_compaction_and_growth(self):
+        vectors = random_vectors(200)
+        cache = SemanticCache(threshold=0.9, max_entries=10, ann_threshold=10**9)
+        for i, vector in enumerate(vectors):
+            cache.add(vector, str(i), context=i % 3)
+            self.assertLessEqual(len(cache), 10)
+            # Every live entry is still found under its own context after each move
+            for j in range(max(0, i - 9), i + 1):
+                self.assertEqual(cache.lookup(vectors[j], context=j % 3), str(j))
+        self.assertIsNone(cache.lookup(vectors[189], context=189 % 3))
+        # Capacity is capped at twice max_entries
+        self.assertLessEqual(cache._vectors.shape[0], 20)
+
+    def test_embedding_size_change_clears_entries(self):
+        cache = SemanticCache(threshold=0.9, ann_threshold=10**9)
+        cache.add(random_vectors(1)[0], "small")
+        wide = random_vectors(1, dim=2 * DIM)[0]
+        self.assertIsNone(cache.lookup(wide))
+        cache.add(wide, "wide")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.lookup(wide), "wide")
+        self.assertIsNone(cache.lookup(random_vectors(1)[0]))
+
+    def test_rows_are_stored_in_single_precision(self):
+        cache = SemanticCache()
+        cache.add(random_vectors(1)[0], "a")
+        self.assertEqual(cache._vectors.dtype, np.float32)
+
+@unittest.skipIf(semantic_cache.hnswlib is None, "hnswlib is not installed")
+class SemanticCacheIndexTest(unittest.TestCase):
+    def test_inline_build_without_event_loop(self):
+        vectors = random_vectors(60)
+        cache = SemanticCache(threshold=0.9, max_entries=30, ann_threshold=20)
+        for i, vector in enumerate(vectors):
+            cache.add(vector, str(i), context=i % 2)
+        self.assertIsNotNone(cache._index)
+        for j in range(30, 60):
+            self.assertEqual(cache.lookup(vectors[j], context=j % 2), str(j))
+            self.assertIsNone(cache.lookup(vectors[j], context=(j + 1) % 2))
+        # Evicted entries are deleted from the graph
+        self.assertIsNone(cache.lookup(vectors[5], context=1))
+
+    def test_background_build_catches_up(self):
+        vectors = random_vectors(300)
+        cache = SemanticCache(threshold=0.9, max_entries=100, ann_threshold=50)
+
+        async def run():
+            for i, vector in enumerate(vectors):
+                cache.add(vector, str(i), context=i % 3)
+                if i == 60:
+                    # The build was handed off; lookups use the flat scan meanwhile
+                    self.assertIsNone(cache._index)
+                    self.assertEqual(cache.lookup(vectors[i], context=i % 3), str(i))
+            while cache._maintenance is not None:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        self.assertIsNotNone(cache._index)
+        for j in range(200, 300):
+            self.assertEqual(cache.lookup(vectors[j], context=j % 3), str(j))
+        self.assertIsNone(cache.lookup(vectors[150], context=0))
+
+class SemanticCachePCATest(unittest.TestCase):
+    def test_inline_fit_reduces_dimensions(self):
+        vectors = low_rank_vectors(80)
+        cache = SemanticCache(threshold=0.95, max_entries=50, ann_threshold=10**9,
+                              pca_components=16, pca_samples=40)
+        for i, vector in enumerate(vectors):
+            cache.add(vector, str(i))
+        self.assertEqual(cache._vectors.shape[1], 16)
+        for j in range(30, 80):
+            self.assertEqual(cache.lookup(vectors[j]), str(j))
+
+    def test_waits_for_as_many_rows_as_components(self):
+        cache = SemanticCache(pca_components=16, pca_samples=1, ann_threshold=10**9)
+        for vector in random_vectors(15):
+            cache.add(vector, "x")
+        self.assertIsNone(cache._projection)
+        cache.add(random_vectors(1, seed=1)[0], "y")
+        self.assertEqual(cache._projection.shape, (DIM, 16))
+
+    def test_background_fit_projects_rows_added_meanwhile(self):
+        vectors = low_rank_vectors(200)
+        cache = SemanticCache(threshold=0.95, max_entries=100, ann_threshold=10**9,
+                              pca_components=16, pca_samples=50)
+
+        async def run():
+            for i, vector in enumerate(vectors):
+                cache.add(vector, str(i))
+            while cache._maintenance is not None:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        self.assertEqual(cache._vectors.shape[1], 16)
+        for j in range(100, 200):
+            self.assertEqual(cache.lookup(vectors[j]), str(j))
+
+class CacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_entries_survive_reload(self):
+        vectors = random_vectors(30)
+        cache = SemanticCache(threshold=0.9, max_entries=20, ann_threshold=10**9)
+        cache.attach_store(CacheStore(self.path))
+        for i, vector in enumerate(vectors):
+            cache.add(vector, str(i), context=i % 2)
+        cache.close()
+
+        reloaded = SemanticCache(threshold=0.9, max_entries=20, ann_threshold=10**9)
+        reloaded.attach_store(CacheStore(self.path))
+        self.assertEqual(len(reloaded), 20)
+        for j in range(10, 30):
+            self.assertEqual(reloaded.lookup(vectors[j], context=j % 2), str(j))
+        self.assertIsNone(reloaded.lookup(vectors[5], context=1))
+        reloaded.close()
+
+    def test_rows_from_another_embedding_model_are_skipped(self):
+        cache = SemanticCache(threshold=0.9, ann_threshold=10**9)
+        cache.attach_store(CacheStore(self.path))
+        cache.add(random_vectors(1)[0], "small")
+        wide = random_vectors(2, dim=2 * DIM)
+        cache.add(wide[0], "wide")
+        cache.add(wide[1], "wider")
+        cache.close()
+
+        reloaded = SemanticCache(threshold=0.9, ann_threshold=10**9)
+        reloaded.attach_store(CacheStore(self.path))
+        self.assertEqual(len(reloaded), 2)
+        self.assertEqual(reloaded.lookup(wide[0]), "wide")
+        reloaded.close()
+
+    def test_expired_rows_are_not_loaded(self):
+        time_now = 1_000_000.0
+        clock = FakeClock(time_now)
+        vectors = random_vectors(2)
+        with mock.patch.object(semantic_cache.time, "time", clock):
+            cache = SemanticCache(threshold=0.9, ttl_seconds=60)
+            cache.attach_store(CacheStore(self.path))
+            cache.add(vectors[0], "old")
+            clock.now = time_now + 50
+            cache.add(vectors[1], "new")
+            cache.close()
+
+            clock.now = time_now + 80
+            reloaded = SemanticCache(threshold=0.9, ttl_seconds=60)
+            reloaded.attach_store(CacheStore(self.path))
+            self.assertEqual(len(reloaded), 1)
+            self.assertEqual(reloaded.lookup(vectors[1]), "new")
+            reloaded.close()
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def test_least_recently_used_entry_is_dropped(self):
+        cache = EmbeddingCache(max_entries=2)
+        cache.put("a", [1.0])
+        cache.put("b", [2.0])
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", [3.0])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").dtype, np.float32)
+        self.assertEqual(len(cache), 2)
+
+class EmbeddingBatcherTest(unittest.TestCase):
+    def test_concurrent_requests_share_batches(self):
+        calls = []
+
+        async def embed_many(texts):
+            calls.append(list(texts))
+            await asyncio.sleep(0.01)
+            return [[float(len(text))] for text in texts]
+
+        async def run():
+            batcher = EmbeddingBatcher(embed_many, max_batch=4)
+            results = await asyncio.gather(*(batcher.embed("x" * n) for n in range(1, 11)))
+            await batcher.close()
+            return results
+
+        results = asyncio.run(run())
+        self.assertEqual(results, [[float(n)] for n in range(1, 11)])
+        self.assertEqual([len(batch) for batch in calls], [4, 4, 2])
+
+    def test_failure_reaches_every_caller_in_the_batch(self):
+        async def embed_many(texts):
+            raise RuntimeError("unavailable")
+
+        async def run():
+            batcher = EmbeddingBatcher(embed_many)
+            results = await asyncio.gather(batcher.embed("a"), batcher.embed("b"), return_exceptions=True)
+            await batcher.close()
+            return results
+
+        for result in asyncio.run(run()):
+            self.assertIsInstance(result, RuntimeError)
+
+if __name__ == "__main__":
+    unittest.main()